@@ -46,17 +46,29 @@ def bufcount(filename):
 
 class SentPairDataset(Dataset):
     """ Load sentence pair (sequential or random order) from corpus """
-    def __init__(self, file, batch_size, tokenize, max_len, short_sampling_prob=0.1, pipeline=[]):
+    def __init__(self, file, batch_size, tokenize, max_len, short_sampling_prob=0.1, pipeline=[],
+                 rank=0, world_size=1):
         super().__init__()
         self.f_pos = open(file, "r", encoding='utf-8', errors='ignore') # for a positive sample
         self.f_neg = open(file, "r", encoding='utf-8', errors='ignore') # for a negative (random) sample
+        # `__getitem__` reads the corpus sequentially and ignores `idx`, so shard it for distributed
+        # training by starting each rank at its own 1/world_size of the file
+        self.f_pos.seek(0, 2)
+        self.shard_offset = self.f_pos.tell() * rank // world_size
+        self.seek_shard()
         self.tokenize = tokenize # tokenize function
-        self.size = bufcount(file)
+        self.size = bufcount(file) // world_size
         self.max_len = max_len # maximum length of tokens
         self.short_sampling_prob = short_sampling_prob
         self.pipeline = pipeline
         self.batch_size = batch_size
 
+    def seek_shard(self):
+        """ move the positive file pointer to the start of this rank's shard """
+        self.f_pos.seek(self.shard_offset, 0)
+        if self.shard_offset:
+            self.f_pos.readline() # throw away an incomplete sentence
+
     def read_tokens(self, f, length, discard_last_and_restart=True):
         """ Read tokens from file pointer with limited length """
         tokens = []
@@ -91,7 +103,7 @@ class SentPairDataset(Dataset):
         tokens_b = self.read_tokens(f_next, len_tokens, False)
 
         if tokens_a is None or tokens_b is None: # end of file
-            self.f_pos.seek(0, 0) # reset file pointer
+            self.seek_shard() # reset file pointer
             self.f_neg.seek(0, 0)
 
             # re-read token
@@ -115,6 +127,8 @@ class SentPairDataset(Dataset):
 
 def seq_collate(batch):
     batch_tensors = [torch.tensor(x, dtype=torch.long) for x in zip(*batch)]
+    # masked_weights are only used as loss weights, so build them as float once here
+    batch_tensors[5] = batch_tensors[5].float()
     return batch_tensors    
 
 
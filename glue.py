@@ -15,7 +15,8 @@ import models
 # import optim
 import train
 import argparse
-from utils import set_seeds, get_device, truncate_tokens_pair
+from torch.utils.data.distributed import DistributedSampler
+from utils import set_seeds, get_device, truncate_tokens_pair, init_distributed
 
 class CsvDataset(Dataset):
     """ Dataset Class for CSV file """
@@ -166,13 +167,12 @@ class Classifier(nn.Module):
         self.fc = nn.Linear(cfg.hidden, cfg.hidden)
         self.activ = nn.ReLU()
         self.drop = nn.Dropout(cfg.p_drop_hidden)
-        self.pool = nn.AdaptiveMaxPool1d(1)
         self.classifier = nn.Linear(cfg.hidden, n_labels)
 
     def forward(self, input_ids, segment_ids, input_mask):
         h = self.transformer(input_ids, segment_ids, input_mask)
-        # only use the first h in the sequence
-        h = self.pool(h.transpose(1, 2)).squeeze(-1)
+        # max-pool over the sequence, (B, S, D) -> (B, D) without a strided transpose or argmax indices
+        h = h.amax(dim=1)
         pooled_h = self.activ(self.fc(h))
         logits = self.classifier(self.drop(pooled_h))
         return logits
@@ -196,6 +196,7 @@ def main(task='mrpc',
     model_cfg = models.Config.from_json(model_cfg)
 
     set_seeds(cfg.seed)
+    distributed = init_distributed() >= 0 # launched with torchrun
 
     tokenizer = tokenization.FullTokenizer(vocab_file=vocab, do_lower_case=True)
     TaskDataset = dataset_class(task) # task dataset class according to the task
@@ -204,7 +205,11 @@ def main(task='mrpc',
                 TokenIndexing(tokenizer.convert_tokens_to_ids,
                               TaskDataset.labels, max_len)]
     dataset = TaskDataset(data_file, pipeline)
-    data_iter = DataLoader(dataset, batch_size=cfg.batch_size, shuffle=True)
+    # shard only for training, evaluation reports accuracy over the whole dataset
+    sampler = DistributedSampler(dataset) if distributed and mode == 'train' else None
+    data_iter = DataLoader(dataset, batch_size=cfg.batch_size, shuffle=sampler is None,
+                           sampler=sampler, pin_memory=True,
+                           drop_last=cfg.compile and mode == 'train') # a smaller last batch would recompile
 
     model = Classifier(model_cfg, len(TaskDataset.labels))
     model.train()
@@ -8,12 +8,13 @@
 
 import math
 import json
+import functools
 from typing import NamedTuple
 
-import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 from utils import split_last, merge_last
 
@@ -30,10 +31,13 @@ class Config(NamedTuple):
     #activ_fn: str = "gelu" # Non-linear Activation Function Type in Hidden Layers
     max_len: int = 512 # Maximum Length for Positional Embeddings
     n_segments: int = 2 # Number of Sentence Segments
+    use_checkpoint: bool = False # Recompute Block activations in backward to save memory
 
     @classmethod
+    @functools.lru_cache(maxsize=None) # configs are immutable, parse each file once
     def from_json(cls, file):
-        return cls(**json.load(open(file, "r")))
+        with open(file, "r") as f:
+            return cls(**json.load(f))
 
 
 def gelu(x):
@@ -93,7 +97,6 @@ class MultiHeadedSelfAttention(nn.Module):
         self.proj_k = nn.Linear(cfg.hidden, cfg.hidden)
         self.proj_v = nn.Linear(cfg.hidden, cfg.hidden)
         # self.drop = nn.Dropout(cfg.p_drop_attn)
-        self.scores = None # for visualization
         self.n_heads = cfg.n_heads
 
     def forward(self, x, mask):
@@ -106,18 +109,15 @@ class MultiHeadedSelfAttention(nn.Module):
         q, k, v = self.proj_q(x), self.proj_k(x), self.proj_v(x)
         q, k, v = (split_last(x, (self.n_heads, -1)).transpose(1, 2)
                    for x in [q, k, v])
-        # (B, H, S, W) @ (B, H, W, S) -> (B, H, S, S) -softmax-> (B, H, S, S)
-        scores = q @ k.transpose(-2, -1) / np.sqrt(k.size(-1))
+        # softmax(q @ k^T / sqrt(W)) @ v : (B, H, S, W) -> (B, H, S, W) -trans-> (B, S, H, W)
+        # with a padding mask this dispatches to the memory-efficient kernel (torch>=2.1), which never
+        # materializes the (B, H, S, S) scores; FlashAttention itself does not accept attn_mask
         if mask is not None:
-            mask = mask[:, None, None, :].float()
-            scores -= 10000.0 * (1.0 - mask)
-        #scores = self.drop(F.softmax(scores, dim=-1))
-        scores = F.softmax(scores, dim=-1)
-        # (B, H, S, S) @ (B, H, S, W) -> (B, H, S, W) -trans-> (B, S, H, W)
-        h = (scores @ v).transpose(1, 2).contiguous()
+            mask = mask[:, None, None, :].bool() # True for tokens to attend to
+        h = F.scaled_dot_product_attention(q, k, v, attn_mask=mask, is_causal=False)
+        h = h.transpose(1, 2).contiguous()
         # -merge-> (B, S, D)
         h = merge_last(h, 2)
-        self.scores = scores
         return h
 
 
@@ -163,12 +163,16 @@ class Transformer(nn.Module):
         # To used parameter-sharing strategies
         self.n_layers = cfg.n_layers
         self.block = Block(cfg)
+        self.use_checkpoint = cfg.use_checkpoint
 
     def forward(self, x, seg, mask):
         h = self.embed(x, seg)
 
         for _ in range(self.n_layers):
-            h = self.block(h, mask)
+            if self.use_checkpoint and self.training:
+                h = checkpoint(self.block, h, mask, use_reentrant=False)
+            else:
+                h = self.block(h, mask)
 
         return h
 
@@ -18,7 +18,7 @@ import tokenization
 import models
 import optim
 import train
-from utils import set_seeds, get_device
+from utils import set_seeds, get_device, init_distributed, get_world, is_main_process
 from torch.utils.data import Dataset, DataLoader
 from data import seek_random_offset, SentPairDataset, Pipeline, Preprocess4Pretrain, seq_collate
 
@@ -97,7 +97,9 @@ class ELECTRA():
         model_cfg = models.Config.from_json(args.model_cfg)
         generator_cfg = models.Config.from_json(args.generator_cfg)
         assert model_cfg.max_len == generator_cfg.max_len
-        set_seeds(cfg.seed)
+        init_distributed() # NCCL process group when launched with torchrun
+        rank, world_size = get_world()
+        set_seeds(cfg.seed + rank) # ranks draw different masks and negative samples
 
         tokenizer = tokenization.FullTokenizer(vocab_file=args.vocab, do_lower_case=True)
         tokenize = lambda x: tokenizer.tokenize(tokenizer.convert_to_unicode(x))
@@ -110,14 +112,20 @@ class ELECTRA():
                                         args.mask_alpha,
                                         args.mask_beta,
                                         args.max_gram)]
-        data_iter = DataLoader(SentPairDataset(args.data_file,
-                                    cfg.batch_size,
-                                    tokenize,
-                                    model_cfg.max_len,
-                                    pipeline=pipeline), 
+        dataset = SentPairDataset(args.data_file,
+                                  cfg.batch_size,
+                                  tokenize,
+                                  model_cfg.max_len,
+                                  pipeline=pipeline,
+                                  rank=rank,
+                                  world_size=world_size)
+        data_iter = DataLoader(dataset,
                                 batch_size=cfg.batch_size, 
+                                drop_last=cfg.compile, # a smaller last batch would recompile the CUDA graphs
                                 collate_fn=seq_collate,
-                                num_workers=mp.cpu_count())
+                                num_workers=mp.cpu_count(),
+                                persistent_workers=True, # keep workers alive across epochs
+                                pin_memory=True)
 
         discriminator = Discriminator(model_cfg)
         generator = Generator(generator_cfg)
@@ -129,12 +137,13 @@ class ELECTRA():
             data_iter, 
             self.optimizer, args.ratio, args.save_dir, get_device())
         os.makedirs(os.path.join(args.log_dir, args.name), exist_ok=True)
-        self.writer = SummaryWriter(log_dir=os.path.join(args.log_dir, args.name)) # for tensorboardX
+        # for tensorboardX, only rank 0 writes so torchrun runs log one curve
+        self.writer = SummaryWriter(log_dir=os.path.join(args.log_dir, args.name)) if is_main_process() else None
 
 
 
     def train(self):
-        self.trainer.train(self.writer, model_file=None, data_parallel=False)
+        self.trainer.train(self.writer, model_file=None, data_parallel=True)
 
 class MaskTrainer():
 
@@ -142,7 +151,9 @@ class MaskTrainer():
         self.args = args
         cfg = train.Config.from_json(args.train_cfg)
         model_cfg = models.Config.from_json(args.model_cfg)
-        set_seeds(cfg.seed)
+        init_distributed() # NCCL process group when launched with torchrun
+        rank, world_size = get_world()
+        set_seeds(cfg.seed + rank) # ranks draw different masks and negative samples
 
         tokenizer = tokenization.FullTokenizer(vocab_file=args.vocab, do_lower_case=True)
         tokenize = lambda x: tokenizer.tokenize(tokenizer.convert_to_unicode(x))
@@ -155,14 +166,20 @@ class MaskTrainer():
                                         args.mask_alpha,
                                         args.mask_beta,
                                         args.max_gram)]
-        data_iter = DataLoader(SentPairDataset(args.data_file,
-                                    cfg.batch_size,
-                                    tokenize,
-                                    model_cfg.max_len,
-                                    pipeline=pipeline), 
+        dataset = SentPairDataset(args.data_file,
+                                  cfg.batch_size,
+                                  tokenize,
+                                  model_cfg.max_len,
+                                  pipeline=pipeline,
+                                  rank=rank,
+                                  world_size=world_size)
+        data_iter = DataLoader(dataset,
                                 batch_size=cfg.batch_size, 
+                                drop_last=cfg.compile, # a smaller last batch would recompile the CUDA graphs
                                 collate_fn=seq_collate,
-                                num_workers=mp.cpu_count())
+                                num_workers=mp.cpu_count(),
+                                persistent_workers=True, # keep workers alive across epochs
+                                pin_memory=True)
 
         model = Generator(model_cfg)
 
@@ -172,10 +189,11 @@ class MaskTrainer():
             data_iter, 
             self.optimizer, args.save_dir, get_device())
         os.makedirs(os.path.join(args.log_dir, args.name), exist_ok=True)
-        self.writer = SummaryWriter(log_dir=os.path.join(args.log_dir, args.name)) # for tensorboardX
+        # for tensorboardX, only rank 0 writes so torchrun runs log one curve
+        self.writer = SummaryWriter(log_dir=os.path.join(args.log_dir, args.name)) if is_main_process() else None
 
     def train(self):
-        self.trainer.train(self.writer, model_file=None, data_parallel=False)
+        self.trainer.train(self.writer, model_file=None, data_parallel=True)
 
 
 
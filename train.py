@@ -8,11 +8,17 @@
 
 import os
 import json
+import contextlib
+import functools
 from typing import NamedTuple
 from tqdm import tqdm
-from torch.autograd import Variable
 import torch
 import torch.nn as nn
+import torch.distributed as dist
+from torch.cuda.amp import GradScaler
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data.distributed import DistributedSampler
+from utils import is_main_process, save_async
 
 class Config(NamedTuple):
     """ Hyperparameters for training """
@@ -24,17 +30,33 @@ class Config(NamedTuple):
     # linearly increasing learning rate from zero to the specified value(5e-5)
     warmup: float = 0.1
     save_steps: int = 100 # interval for saving model
+    log_steps: int = 10 # interval (in iterations) for syncing losses to the progress bar and writer
     total_steps: int = 100000 # total number of steps to train
+    accum_steps: int = 1 # number of micro-batches to accumulate gradients over per optimizer step
+    compile: bool = False # torch.compile the model(s) with CUDA graphs (mode='reduce-overhead')
+    int8_eval: bool = False # evaluate on CPU with dynamically quantized int8 Linear layers
+    amp: bool = True # mixed precision training and evaluation (GPU only) : bf16 if supported, else fp16 with loss scaling
 
     @classmethod
+    @functools.lru_cache(maxsize=None) # configs are immutable, parse each file once
     def from_json(cls, file): # load config from json file
-        return cls(**json.load(open(file, "r")))
+        with open(file, "r") as f:
+            return cls(**json.load(f))
+
+def no_sync(models, skip):
+    "skip the gradient all-reduce of DistributedDataParallel models when skip (accumulation micro-batches)"
+    stack = contextlib.ExitStack()
+    if skip:
+        for model in models:
+            stack.enter_context(model.no_sync())
+    return stack
 
 def generator_loss(model, batch, global_step, optimizer, cross_ent, sent_cross_ent, writer=None, prefix='pretrain'): # make sure loss is tensor
     input_ids, segment_ids, input_mask, masked_ids, masked_pos, masked_weights, is_next, _ = batch
     logits_lm, logits_clsf = model(input_ids, segment_ids, input_mask, masked_pos)
-    loss_lm = cross_ent(logits_lm.transpose(1, 2), masked_ids) # for masked LM
-    loss_lm = (loss_lm*masked_weights.float()).mean()
+    # for masked LM : flatten (B, P, V) -> (B*P, V), a view, instead of a strided (B, V, P) transpose
+    loss_lm = cross_ent(logits_lm.reshape(-1, logits_lm.size(-1)), masked_ids.reshape(-1))
+    loss_lm = (loss_lm*masked_weights.reshape(-1)).mean() # masked_weights are float from seq_collate
     loss_sop = sent_cross_ent(logits_clsf, is_next) # for sentence classification
 
     if writer:
@@ -48,18 +70,21 @@ def generator_loss(model, batch, global_step, optimizer, cross_ent, sent_cross_e
     return loss_lm + loss_sop, logits_lm, loss_sop
 
 
+@torch.jit.script
+def replace_tokens(masked_ids, sampled_ids, original_ids):
+    "discriminator input and targets in one fused elementwise kernel (no boolean indexing, no host sync)"
+    masked_label = masked_ids != original_ids
+    # replace the non masked generator token with the original token
+    input_ids = torch.where(masked_label, sampled_ids, original_ids)
+    is_replaced = (input_ids != original_ids).float()
+    return input_ids, is_replaced, masked_label
+
+
 def discriminator_loss(generator, discriminator, batch, global_step, optimizer, cross_ent, sent_cross_ent, writer=None, prefix='pretrain'): # make sure loss is tensor
-    # input_ids is the output of generator
+    # input_ids is the output of generator, scattered back to (B, max_len) at masked_pos
     #   0           1           2           3
     masked_ids, segment_ids, input_mask, input_ids, _, _, is_next, original_ids = batch
-    masked_label = (masked_ids.long() != original_ids)
-
-    # replace the non masked generator token with the original token
-    non_masked_label = (masked_ids == original_ids) 
-    input_ids[non_masked_label] = original_ids[non_masked_label]
-
-    is_replaced = Variable((input_ids.long() != original_ids.long()).float())
-    is_replaced = is_replaced.cuda()
+    input_ids, is_replaced, masked_label = replace_tokens(masked_ids, input_ids, original_ids)
 
     logits_lm, logits_clsf = discriminator(input_ids, segment_ids, input_mask)
     logits_lm = logits_lm.squeeze(-1)
@@ -93,68 +118,97 @@ class Trainer(object):
         self.optimizer = optimizer
         self.save_dir = save_dir
         self.device = device # device name
+        self.amp = cfg.amp and torch.device(device).type == 'cuda'
+        self.amp_dtype = torch.bfloat16 if self.amp and torch.cuda.is_bf16_supported() else torch.float16
+        # bf16 has the fp32 exponent range, so loss scaling is only needed for fp16
+        self.scaler = GradScaler(enabled=self.amp and self.amp_dtype == torch.float16)
+        self.save_thread = None # background thread writing the last checkpoint
 
     def train(self, get_loss, model_file=None, pretrain_file=None, data_parallel=True):
         """ Train Loop """
         self.model.train() # train mode
+        model = self.model.to(self.device) # move first, so checkpoints load straight into device memory
         self.load(model_file, pretrain_file)
-        model = self.model.to(self.device)
-        if data_parallel: # use Data Parallelism with Multi-GPU
-            model = nn.DataParallel(model)
-
-        global_step = 0 # global iteration steps regardless of epochs
+        ddp_models = [] # wrapped before torch.compile, for no_sync
+        if data_parallel and dist.is_initialized(): # use Distributed Data Parallelism with Multi-GPU
+            # all-reduce gradient buckets as they become ready during backward, straight into .grad
+            model = DistributedDataParallel(model, device_ids=[torch.cuda.current_device()],
+                                            gradient_as_bucket_view=True, static_graph=True)
+            ddp_models = [model]
+        if self.cfg.compile: # inputs are padded to max_len and loaders drop_last, so shapes stay static
+            model = torch.compile(model, mode='reduce-overhead')
+
+        global_step = 0 # global optimizer steps regardless of epochs
+        n_iter = len(self.data_iter) # micro-batches per epoch
+        main = is_main_process() # only rank 0 logs under torchrun
         for e in range(self.cfg.n_epochs):
-            loss_sum = 0. # the sum of iteration losses to get average loss in every epoch
-            iter_bar = tqdm(self.data_iter, desc='Iter (loss=X.XXX)', dynamic_ncols=True)
+            loss_sum = torch.zeros((), device=self.device) # the sum of iteration losses to get average loss in every epoch
+            if isinstance(self.data_iter.sampler, DistributedSampler):
+                self.data_iter.sampler.set_epoch(e) # reshuffle the shards every epoch
+            iter_bar = tqdm(self.data_iter, desc='Iter (loss=X.XXX)', dynamic_ncols=True, disable=not main)
             for i, batch in enumerate(iter_bar):
-                batch = [t.to(self.device) for t in batch]
-
-                self.optimizer.zero_grad()
-                loss = get_loss(model, batch, global_step).mean() # mean() for Data Parallelism
-                loss.backward()
-                self.optimizer.step()
-
+                batch = [t.to(self.device, non_blocking=True) for t in batch]
+                log = main and i % self.cfg.log_steps == 0 # .item() syncs with the GPU, so only read losses every log_steps
+                # the last window of an epoch may hold fewer than accum_steps micro-batches
+                window = min(self.cfg.accum_steps, n_iter - i // self.cfg.accum_steps * self.cfg.accum_steps)
+                last = (i + 1) % self.cfg.accum_steps == 0 or i + 1 == n_iter # step the optimizer after this one
+
+                if i % self.cfg.accum_steps == 0:
+                    self.optimizer.zero_grad(set_to_none=True) # free grads instead of zero-filling them
+                with no_sync(ddp_models, skip=not last): # all-reduce only on the micro-batch that steps
+                    with torch.autocast('cuda', dtype=self.amp_dtype, enabled=self.amp):
+                        loss = get_loss(model, batch, global_step) # DistributedDataParallel keeps the loss a scalar
+                    self.scaler.scale(loss / window).backward()
+
+                loss_sum += loss.detach()
+                if log:
+                    iter_bar.set_description('Iter (loss=%5.3f)'%loss.item())
+
+                if not last: # keep accumulating gradients
+                    continue
+                self.scaler.step(self.optimizer)
+                self.scaler.update()
                 global_step += 1
-                loss_sum += loss.item()
-                iter_bar.set_description('Iter (loss=%5.3f)'%loss.item())
 
                 if global_step % self.cfg.save_steps == 0: # save
                     self.save(global_step)
 
                 if self.cfg.total_steps and self.cfg.total_steps < global_step:
-                    print('Epoch %d/%d : Average Loss %5.3f'%(e+1, self.cfg.n_epochs, loss_sum/(i+1)))
-                    print('The Total Steps have been reached.')
-                    self.save(global_step) # save and finish when global_steps reach total_steps
+                    if main:
+                        print('Epoch %d/%d : Average Loss %5.3f'%(e+1, self.cfg.n_epochs, loss_sum.item()/(i+1)))
+                        print('The Total Steps have been reached.')
+                    self.save(global_step, wait=True) # save and finish when global_steps reach total_steps
                     return
 
-            print('Epoch %d/%d : Average Loss %5.3f'%(e+1, self.cfg.n_epochs, loss_sum/(i+1)))
-        self.save(global_step)
+            if main:
+                print('Epoch %d/%d : Average Loss %5.3f'%(e+1, self.cfg.n_epochs, loss_sum.item()/(i+1)))
+        self.save(global_step, wait=True) # callers may load the final checkpoint right away
 
     def eval(self, evaluate, model_file, data_parallel=True):
         """ Evaluation Loop """
         self.model.eval() # evaluation mode
+        model = self.model.to(self.device) # move first, so checkpoints load straight into device memory
         self.load(model_file, None)
-        model = self.model.to(self.device)
-        with torch.no_grad():
-            if data_parallel: # use Data Parallelism with Multi-GPU
-                model = nn.DataParallel(model)
-
-            results = [] # prediction results
-            iter_bar = tqdm(self.data_iter, desc='Iter (loss=X.XXX)')
-            for batch in iter_bar:
-                batch = [t.to(self.device) for t in batch]
-                with torch.no_grad(): # evaluation without gradient calculation
-                    accuracy, result = evaluate(model, batch) # accuracy to print
-                results.append(result)
-
-                iter_bar.set_description('Iter(acc=%5.3f)'%accuracy)
+        if self.cfg.int8_eval and torch.device(self.device).type == 'cpu':
+            model = torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+        results = [] # prediction results
+        iter_bar = tqdm(self.data_iter, desc='Iter (loss=X.XXX)')
+        for batch in iter_bar:
+            batch = [t.to(self.device, non_blocking=True) for t in batch]
+            # evaluation without autograd tracking (no grad, no version counters)
+            with torch.inference_mode(), torch.autocast('cuda', dtype=self.amp_dtype, enabled=self.amp):
+                accuracy, result = evaluate(model, batch) # accuracy to print
+            results.append(result)
+
+            iter_bar.set_description('Iter(acc=%5.3f)'%accuracy)
         return results
 
     def load(self, model_file, pretrain_file):
         """ load saved model or pretrained transformer (a part of model) """
         if model_file:
             print('Loading the model from', model_file)
-            self.model.load_state_dict(torch.load(model_file))
+            self.model.load_state_dict(torch.load(model_file, map_location=self.device))
 
         elif pretrain_file: # use pretrained transformer
             if pretrain_file.endswith('.ckpt'): # checkpoint file in tensorflow
@@ -163,15 +217,25 @@ class Trainer(object):
                 print('Loading the pretrained model from', pretrain_file)
                 self.model.transformer.load_state_dict(
                     {key[12:]: value
-                        for key, value in torch.load(pretrain_file).items()
+                        for key, value in torch.load(pretrain_file, map_location=self.device).items()
                         if key.startswith('transformer')}
                 ) # load only transformer parts
 
 
-    def save(self, i):
-        """ save current model """
-        torch.save(self.model.state_dict(), # save model object before nn.DataParallel
-            os.path.join(self.save_dir, 'model_steps_'+str(i)+'.pt'))
+    def save(self, i, wait=False):
+        """ save current model, wait=True blocks until the file is written """
+        if not is_main_process(): # every rank holds the same weights
+            if wait and dist.is_initialized():
+                dist.barrier() # other ranks may load the file next, wait for rank 0 to write it
+            return
+        if self.save_thread is not None:
+            self.save_thread.join() # keep at most one checkpoint in flight
+        self.save_thread = save_async({ # save model object before DistributedDataParallel
+            os.path.join(self.save_dir, 'model_steps_'+str(i)+'.pt'): self.model.state_dict()})
+        if wait:
+            self.save_thread.join()
+            if dist.is_initialized():
+                dist.barrier()
 
 class MLMTrainer(object):
     """Training Helper Class"""
@@ -182,6 +246,11 @@ class MLMTrainer(object):
         self.optimizer = optimizer
         self.save_dir = save_dir
         self.device = device # device name
+        self.amp = cfg.amp and torch.device(device).type == 'cuda'
+        self.amp_dtype = torch.bfloat16 if self.amp and torch.cuda.is_bf16_supported() else torch.float16
+        # bf16 has the fp32 exponent range, so loss scaling is only needed for fp16
+        self.scaler = GradScaler(enabled=self.amp and self.amp_dtype == torch.float16)
+        self.save_thread = None # background thread writing the last checkpoint
         self.cross_ent = nn.CrossEntropyLoss(reduction='none')
         self.sent_cross_ent = nn.CrossEntropyLoss()
 
@@ -191,58 +260,81 @@ class MLMTrainer(object):
         if isinstance(self.model, tuple):
             for m in self.model:
                 m.train() # train mode
+        model = self.model.to(self.device) # move first, so checkpoints load straight into device memory
         self.load(model_file)
-        model = self.model.to(self.device)
-        if data_parallel: # use Data Parallelism with Multi-GPU
-            model = nn.DataParallel(model)
-
-        global_step = 0 # global iteration steps regardless of epochs
+        ddp_models = [] # wrapped before torch.compile, for no_sync
+        if data_parallel and dist.is_initialized(): # use Distributed Data Parallelism with Multi-GPU
+            # all-reduce gradient buckets as they become ready during backward, straight into .grad
+            model = DistributedDataParallel(model, device_ids=[torch.cuda.current_device()],
+                                            gradient_as_bucket_view=True, static_graph=True)
+            ddp_models = [model]
+        if self.cfg.compile: # inputs are padded to max_len and loaders drop_last, so shapes stay static
+            model = torch.compile(model, mode='reduce-overhead')
+
+        global_step = 0 # global optimizer steps regardless of epochs
+        n_iter = len(self.data_iter) # micro-batches per epoch
+        main = is_main_process() # only rank 0 logs under torchrun
         for e in range(self.cfg.n_epochs):
-            loss_sum = 0. # the sum of iteration losses to get average loss in every epoch
-            iter_bar = tqdm(self.data_iter, desc='Iter (loss=X.XXX)')
+            loss_sum = torch.zeros((), device=self.device) # the sum of iteration losses to get average loss in every epoch
+            if isinstance(self.data_iter.sampler, DistributedSampler):
+                self.data_iter.sampler.set_epoch(e) # reshuffle the shards every epoch
+            iter_bar = tqdm(self.data_iter, desc='Iter (loss=X.XXX)', disable=not main)
             for i, batch in enumerate(iter_bar):
-                batch = [t.to(self.device) for t in batch]
-
-                self.optimizer.zero_grad()
-                loss, loss_lm, _ = generator_loss(model, batch, global_step, 
-                    self.optimizer,
-                    self.cross_ent, self.sent_cross_ent,
-                    writer, prefix='train'
-                    )
-                if data_parallel:
-                    loss = loss.mean()
-                loss.backward()
-                self.optimizer.step()
-
+                batch = [t.to(self.device, non_blocking=True) for t in batch]
+                log = main and i % self.cfg.log_steps == 0 # .item() syncs with the GPU, so only read losses every log_steps
+                # the last window of an epoch may hold fewer than accum_steps micro-batches
+                window = min(self.cfg.accum_steps, n_iter - i // self.cfg.accum_steps * self.cfg.accum_steps)
+                last = (i + 1) % self.cfg.accum_steps == 0 or i + 1 == n_iter # step the optimizer after this one
+
+                if i % self.cfg.accum_steps == 0:
+                    self.optimizer.zero_grad(set_to_none=True) # free grads instead of zero-filling them
+                with no_sync(ddp_models, skip=not last): # all-reduce only on the micro-batch that steps
+                    with torch.autocast('cuda', dtype=self.amp_dtype, enabled=self.amp):
+                        loss, loss_lm, _ = generator_loss(model, batch, global_step, 
+                            self.optimizer,
+                            self.cross_ent, self.sent_cross_ent,
+                            writer if log else None, prefix='train'
+                            )
+                    self.scaler.scale(loss / window).backward()
+
+                loss_sum += loss.detach()
+                if log:
+                    iter_bar.set_description('Iter (loss=%5.3f)'%loss.item())
+
+                if not last: # keep accumulating gradients
+                    continue
+                self.scaler.step(self.optimizer)
+                self.scaler.update()
                 global_step += 1
-                loss_sum += loss.item()
-                iter_bar.set_description('Iter (loss=%5.3f)'%loss.item())
 
                 if global_step % self.cfg.save_steps == 0: # save
                     self.save(global_step)
 
                 if self.cfg.total_steps and self.cfg.total_steps < global_step:
-                    print('Epoch %d/%d : Average Loss %5.3f'%(e+1, self.cfg.n_epochs, loss_sum/(i+1)))
-                    print('The Total Steps have been reached.')
-                    self.save(global_step) # save and finish when global_steps reach total_steps
+                    if main:
+                        print('Epoch %d/%d : Average Loss %5.3f'%(e+1, self.cfg.n_epochs, loss_sum.item()/(i+1)))
+                        print('The Total Steps have been reached.')
+                    self.save(global_step, wait=True) # save and finish when global_steps reach total_steps
                     return
 
-            print('Epoch %d/%d : Average Loss %5.3f'%(e+1, self.cfg.n_epochs, loss_sum/(i+1)))
-        self.save(global_step)
+            if main:
+                print('Epoch %d/%d : Average Loss %5.3f'%(e+1, self.cfg.n_epochs, loss_sum.item()/(i+1)))
+        self.save(global_step, wait=True) # callers may load the final checkpoint right away
 
     def eval(self, evaluate, model_file, data_parallel=True):
         """ Evaluation Loop """
         self.model.eval() # evaluation mode
+        model = self.model.to(self.device) # move first, so checkpoints load straight into device memory
         self.load(model_file)
-        model = self.model.to(self.device)
-        if data_parallel: # use Data Parallelism with Multi-GPU
-            model = nn.DataParallel(model)
+        if self.cfg.int8_eval and torch.device(self.device).type == 'cpu':
+            model = torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
 
         results = [] # prediction results
         iter_bar = tqdm(self.data_iter, desc='Iter (loss=X.XXX)')
         for batch in iter_bar:
-            batch = [t.to(self.device) for t in batch]
-            with torch.no_grad(): # evaluation without gradient calculation
+            batch = [t.to(self.device, non_blocking=True) for t in batch]
+            # evaluation without autograd tracking (no grad, no version counters)
+            with torch.inference_mode(), torch.autocast('cuda', dtype=self.amp_dtype, enabled=self.amp):
                 accuracy, result = evaluate(model, batch) # accuracy to print
             results.append(result)
 
@@ -253,13 +345,22 @@ class MLMTrainer(object):
         """ load saved model or pretrained transformer (a part of model) """
         if model_file:
             print('Loading the model from', model_file)
-            self.model.load_state_dict(torch.load(model_file))
-
-    def save(self, i):
-        """ save current model """
-        torch.save(self.model, os.path.join(self.save_dir, 'backbone.pt'))
-        torch.save(self.model.state_dict(), # save model object before nn.DataParallel
-            os.path.join(self.save_dir, 'model_steps_'+str(i)+'.pt'))
+            self.model.load_state_dict(torch.load(model_file, map_location=self.device))
+
+    def save(self, i, wait=False):
+        """ save current model, wait=True blocks until the file is written """
+        if not is_main_process(): # every rank holds the same weights
+            if wait and dist.is_initialized():
+                dist.barrier() # other ranks may load the file next, wait for rank 0 to write it
+            return
+        if self.save_thread is not None:
+            self.save_thread.join() # keep at most one checkpoint in flight
+        self.save_thread = save_async({ # save model object before DistributedDataParallel
+            os.path.join(self.save_dir, 'model_steps_'+str(i)+'.pt'): self.model.state_dict()})
+        if wait:
+            self.save_thread.join()
+            if dist.is_initialized():
+                dist.barrier()
 
 
 class AdversarialTrainer(object):
@@ -273,6 +374,11 @@ class AdversarialTrainer(object):
         self.ratio = ratio
         self.save_dir = save_dir
         self.device = device # device name
+        self.amp = cfg.amp and torch.device(device).type == 'cuda'
+        self.amp_dtype = torch.bfloat16 if self.amp and torch.cuda.is_bf16_supported() else torch.float16
+        # bf16 has the fp32 exponent range, so loss scaling is only needed for fp16
+        self.scaler = GradScaler(enabled=self.amp and self.amp_dtype == torch.float16)
+        self.save_thread = None # background thread writing the last checkpoint
         self.d_bce_loss = nn.BCEWithLogitsLoss(reduction='none')
         self.cross_ent = nn.CrossEntropyLoss(reduction='none')
         self.sent_cross_ent = nn.CrossEntropyLoss()
@@ -281,77 +387,105 @@ class AdversarialTrainer(object):
         """ Train Loop """
         self.discriminator.train() # train mode
         self.generator.train()
-        self.load(model_file)
-        generator = self.generator.to(self.device)
+        generator = self.generator.to(self.device) # move first, so checkpoints load straight into device memory
         discriminator = self.discriminator.to(self.device)
-        if data_parallel: # use Data Parallelism with Multi-GPU
-            discriminator = nn.DataParallel(discriminator)
-            generator = nn.DataParallel(generator)
-
-        global_step = 0 # global iteration steps regardless of epochs
+        self.load(model_file)
+        ddp_models = [] # wrapped before torch.compile, for no_sync
+        if data_parallel and dist.is_initialized(): # use Distributed Data Parallelism with Multi-GPU
+            # all-reduce gradient buckets as they become ready during backward, straight into .grad
+            # static_graph also covers the discriminator's pretraining head (linear, norm) unused in forward
+            discriminator = DistributedDataParallel(discriminator, device_ids=[torch.cuda.current_device()],
+                                                    gradient_as_bucket_view=True, static_graph=True)
+            generator = DistributedDataParallel(generator, device_ids=[torch.cuda.current_device()],
+                                                gradient_as_bucket_view=True, static_graph=True)
+            ddp_models = [generator, discriminator]
+        if self.cfg.compile: # inputs are padded to max_len and loaders drop_last, so shapes stay static
+            generator = torch.compile(generator, mode='reduce-overhead')
+            discriminator = torch.compile(discriminator, mode='reduce-overhead')
+
+        global_step = 0 # global optimizer steps regardless of epochs
+        n_iter = len(self.data_iter) # micro-batches per epoch
+        main = is_main_process() # only rank 0 logs under torchrun
         for e in range(self.cfg.n_epochs):
-            loss_sum = 0. # the sum of iteration losses to get average loss in every epoch
-            iter_bar = tqdm(self.data_iter, desc='Iter (loss=X.XXX)')
+            loss_sum = torch.zeros((), device=self.device) # the sum of iteration losses to get average loss in every epoch
+            if isinstance(self.data_iter.sampler, DistributedSampler):
+                self.data_iter.sampler.set_epoch(e) # reshuffle the shards every epoch
+            iter_bar = tqdm(self.data_iter, desc='Iter (loss=X.XXX)', disable=not main)
             for i, batch in enumerate(iter_bar):
-                batch = [t.to(self.device) for t in batch]
-
-                self.optimizer.zero_grad()
-                g_loss, generate_logits, _ = generator_loss(generator, batch, global_step, 
-                    self.optimizer,
-                    self.cross_ent, self.sent_cross_ent,
-                    writer, prefix='train'
-                    )
-                # g_loss.backward()
-                if data_parallel:
-                    g_loss.mean()
-
+                batch = [t.to(self.device, non_blocking=True) for t in batch]
+                log = main and i % self.cfg.log_steps == 0 # .item() syncs with the GPU, so only read losses every log_steps
+                # the last window of an epoch may hold fewer than accum_steps micro-batches
+                window = min(self.cfg.accum_steps, n_iter - i // self.cfg.accum_steps * self.cfg.accum_steps)
+                last = (i + 1) % self.cfg.accum_steps == 0 or i + 1 == n_iter # step the optimizer after this one
+
+                if i % self.cfg.accum_steps == 0:
+                    self.optimizer.zero_grad(set_to_none=True) # free grads instead of zero-filling them
+                with no_sync(ddp_models, skip=not last): # all-reduce only on the micro-batch that steps
+                    with torch.autocast('cuda', dtype=self.amp_dtype, enabled=self.amp):
+                        g_loss, generate_logits, _ = generator_loss(generator, batch, global_step, 
+                            self.optimizer,
+                            self.cross_ent, self.sent_cross_ent,
+                            writer if log else None, prefix='train'
+                            )
+                    # g_loss.backward()
+
+                    # self.d_optimizer.zero_grad()
+                    # generator samples are (B, max_pred) at masked_pos, scatter them back into a (B, max_len)
+                    # copy of the masked input; padded masked_pos slots point at [CLS], which replace_tokens
+                    # restores since it is never masked
+                    sampled_ids = generate_logits.argmax(dim=-1) # sampled on device, argmax carries no grad
+                    batch[3] = batch[0].scatter(1, batch[4], sampled_ids)
+                    with torch.autocast('cuda', dtype=self.amp_dtype, enabled=self.amp):
+                        _, lm_loss, nsp_loss = discriminator_loss(generator, discriminator, batch, global_step, 
+                            self.optimizer,
+                            self.d_bce_loss, self.sent_cross_ent,
+                            writer if log else None, prefix='train')
+                    d_loss = lm_loss*self.ratio + nsp_loss
+
+                    total_loss = g_loss + d_loss
+
+                    loss_sum += total_loss.detach()
+
+                    self.scaler.scale(total_loss / window).backward()
+
+                if log:
+                    iter_bar.set_description('(d_loss: {:5.3f}, g_loss: {:5.3f}, loss: {:5.3f})'.format( d_loss.item(), g_loss.item(), float(total_loss.item()) ) )
+
+                if not last: # keep accumulating gradients
+                    continue
+                self.scaler.step(self.optimizer)
+                self.scaler.update()
                 global_step += 1
-                # self.d_optimizer.zero_grad()
-                batch[3] = torch.argmax(generate_logits, dim=2).detach()
-                _, lm_loss, nsp_loss = discriminator_loss(generator, discriminator, batch, global_step, 
-                    self.optimizer,
-                    self.d_bce_loss, self.sent_cross_ent,
-                    writer, prefix='train')
-                d_loss = lm_loss*self.ratio + nsp_loss
-                if data_parallel:
-                    d_loss.mean()
-
-                total_loss = g_loss + d_loss
-
-                loss_sum += total_loss.item()
-
-                total_loss.backward()
-
-                self.optimizer.step()
-
-                iter_bar.set_description('(d_loss: {:5.3f}, g_loss: {:5.3f}, loss: {:5.3f})'.format( d_loss.item(), g_loss.item(), float(total_loss.item()) ) )
 
                 if global_step % self.cfg.save_steps == 0: # save
                     self.save(global_step)
 
                 if self.cfg.total_steps and self.cfg.total_steps < global_step:
-                    print('Epoch %d/%d : Average Loss %5.3f'%(e+1, self.cfg.n_epochs, loss_sum/(i+1)))
-                    print('The Total Steps have been reached.')
-                    self.save(global_step) # save and finish when global_steps reach total_steps
+                    if main:
+                        print('Epoch %d/%d : Average Loss %5.3f'%(e+1, self.cfg.n_epochs, loss_sum.item()/(i+1)))
+                        print('The Total Steps have been reached.')
+                    self.save(global_step, wait=True) # save and finish when global_steps reach total_steps
                     return
 
-            print('Epoch %d/%d : Average Loss %5.3f'%(e+1, self.cfg.n_epochs, loss_sum/(i+1)))
-        self.save(global_step)
+            if main:
+                print('Epoch %d/%d : Average Loss %5.3f'%(e+1, self.cfg.n_epochs, loss_sum.item()/(i+1)))
+        self.save(global_step, wait=True) # callers may load the final checkpoint right away
 
     def eval(self, evaluate, model_file, data_parallel=True):
         """ Evaluation Loop """
         self.generator.eval() # evaluation mode
+        generator = self.generator.to(self.device) # move first, so checkpoints load straight into device memory
         self.load(model_file)
-        generator = self.generator.to(self.device)
-        if data_parallel: # use Data Parallelism with Multi-GPU
-            generator = nn.DataParallel(generator)
+        if self.cfg.int8_eval and torch.device(self.device).type == 'cpu':
+            generator = torch.ao.quantization.quantize_dynamic(generator, {nn.Linear}, dtype=torch.qint8)
 
         results = [] # prediction results
         iter_bar = tqdm(self.data_iter, desc='Iter (loss=X.XXX)')
         for batch in iter_bar:
-            batch = [t.to(self.device) for t in batch]
-            with torch.no_grad(): # evaluation without gradient calculation
-                accuracy, result = evaluate(model, batch) # accuracy to print
+            batch = [t.to(self.device, non_blocking=True) for t in batch]
+            # evaluation without autograd tracking (no grad, no version counters)
+            with torch.inference_mode(), torch.autocast('cuda', dtype=self.amp_dtype, enabled=self.amp):
+                accuracy, result = evaluate(generator, batch) # accuracy to print
             results.append(result)
 
             iter_bar.set_description('Iter(acc=%5.3f)'%accuracy)
@@ -361,11 +495,20 @@ class AdversarialTrainer(object):
         """ load saved model or pretrained transformer (a part of model) """
         if model_file:
             print('Loading the model from', model_file)
-            self.generator.load_state_dict(torch.load(model_file))
-
-    def save(self, i):
-        """ save current model """
-        torch.save(self.generator, os.path.join(self.save_dir, 'g_backbone.pt'))
-        torch.save(self.discriminator, os.path.join(self.save_dir, 'd_backbone.pt'))
-        torch.save(self.discriminator.state_dict(), # save model object before nn.DataParallel
-            os.path.join(self.save_dir, 'd_model_steps_'+str(i)+'.pt'))
+            self.generator.load_state_dict(torch.load(model_file, map_location=self.device))
+
+    def save(self, i, wait=False):
+        """ save current model, wait=True blocks until the file is written """
+        if not is_main_process(): # every rank holds the same weights
+            if wait and dist.is_initialized():
+                dist.barrier() # other ranks may load the file next, wait for rank 0 to write it
+            return
+        if self.save_thread is not None:
+            self.save_thread.join() # keep at most one checkpoint in flight
+        self.save_thread = save_async({ # save model objects before DistributedDataParallel
+            os.path.join(self.save_dir, 'g_model_steps_'+str(i)+'.pt'): self.generator.state_dict(),
+            os.path.join(self.save_dir, 'd_model_steps_'+str(i)+'.pt'): self.discriminator.state_dict()})
+        if wait:
+            self.save_thread.join()
+            if dist.is_initialized():
+                dist.barrier()
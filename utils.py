@@ -9,9 +9,11 @@
 import os
 import random
 import logging
+import threading
 
 import numpy as np
 import torch
+import torch.distributed as dist
 
 
 def set_seeds(seed):
@@ -28,6 +30,39 @@ def get_device():
     print("%s (%d GPUs)" % (device, n_gpu))
     return device
 
+def init_distributed():
+    "init NCCL process group when launched with torchrun, returns local rank (-1 if not distributed)"
+    if 'LOCAL_RANK' not in os.environ:
+        return -1
+    local_rank = int(os.environ['LOCAL_RANK'])
+    torch.cuda.set_device(local_rank)
+    if not dist.is_initialized():
+        dist.init_process_group('nccl')
+    return local_rank
+
+def get_world():
+    "(rank, world_size) of this process, (0, 1) without distributed training"
+    if not dist.is_initialized():
+        return 0, 1
+    return dist.get_rank(), dist.get_world_size()
+
+def is_main_process():
+    "whether this is the rank 0 process (always True without distributed training)"
+    return not dist.is_initialized() or dist.get_rank() == 0
+
+def save_async(checkpoints):
+    "copy {path: state_dict} to CPU and write the files on a background thread, returns the thread"
+    # copy=True : .cpu() would alias parameters already on CPU, which the optimizer keeps updating in place
+    checkpoints = {path: {k: v.detach().to('cpu', copy=True) for k, v in state_dict.items()}
+                   for path, state_dict in checkpoints.items()}
+    def write():
+        for path, state_dict in checkpoints.items():
+            torch.save(state_dict, path)
+    # not a daemon thread : the interpreter waits for the last checkpoint to be written on exit
+    thread = threading.Thread(target=write)
+    thread.start()
+    return thread
+
 def split_last(x, shape):
     "split the last dimension to given shape"
     shape = list(shape)